@@ -27,12 +27,21 @@ Advanced usage:
 
     # Process videos with specific extensions and save as JSON
     caption_videos.py videos_dir/ --extensions mp4,mov,avi --output captions.json
+
+    # Caption only the second of four disjoint slices of the media files (e.g. one slice per GPU)
+    caption_videos.py videos_dir/ --output captions.shard1.json --shard 1/4
+
+    # Also stream each caption record to stdout as JSON Lines (e.g. to pipe into preprocess_dataset.py --stream)
+    caption_videos.py videos_dir/ --output captions.json --stream
 """
 
 import csv
 import json
+import sys
+from contextlib import nullcontext, redirect_stdout
 from enum import Enum
 from pathlib import Path
+from typing import TextIO
 
 import torch
 import typer
@@ -87,6 +96,9 @@ def caption_media(
     clean_caption: bool,
     output_format: OutputFormat,
     override: bool,
+    stream: TextIO | None = None,
+    shard: tuple[int, int] | None = None,
+    skip: set[Path] | None = None,
 ) -> None:
     """Caption videos and images using the provided captioning model.
     Args:
@@ -99,11 +111,25 @@ def caption_media(
         clean_caption: Whether to clean up captions
         output_format: Format to save the captions in
         override: Whether to override existing captions
+        stream: Optional text stream to which each caption record is written as a JSON line as soon as it is available
+        shard: Optional (index, count) pair. If given, only every count-th media file starting at index is processed
+        skip: Optional set of resolved media paths to leave out entirely, e.g. because they were captioned elsewhere
     """
 
     # Get list of media files to process
     media_files = _get_media_files(input_path, extensions, recursive)
 
+    if shard is not None:
+        shard_index, num_shards = shard
+        media_files = media_files[shard_index::num_shards]
+        console.print(f"Processing shard [bold]{shard_index}/{num_shards}[/] of the media files.")
+
+    if skip:
+        num_media_files = len(media_files)
+        media_files = [media_file for media_file in media_files if media_file.resolve() not in skip]
+        num_skipped = num_media_files - len(media_files)
+        console.print(f"[bold yellow]Leaving out [bold]{num_skipped}[/] media from the skip list.[/]")
+
     if not media_files:
         console.print("[bold yellow]No media files found to process.[/]")
         return
@@ -137,6 +163,13 @@ def caption_media(
     if skipped_media:
         console.print(f"[bold yellow]Skipping [bold]{len(skipped_media)}[/] media that already have captions.[/]")
 
+    # Downstream consumers of the stream expect the full dataset, so emit the already captioned media first
+    if stream is not None:
+        for media_file in skipped_media:
+            media_path_str = str(media_file.resolve())
+            rel_path = str(media_file.resolve().relative_to(base_dir))
+            _write_caption_record(stream, rel_path, existing_captions_abs[media_path_str])
+
     if not media_to_process:
         console.print("[bold yellow]No media to process. All media already have captions.[/]")
         console.print("[bold yellow]Use --override to recaption all media.[/]")
@@ -159,7 +192,11 @@ def caption_media(
     # Start with existing captions
     captions = existing_captions.copy()
 
-    with progress:
+    # JSON Lines output is appended to as each caption is generated, so an interrupted run keeps its progress.
+    # The file is rewritten once more at the end, like the other formats.
+    incremental_output = _open_jsonl_for_append(output_path) if output_format == OutputFormat.JSONL else None
+
+    with progress, incremental_output or nullcontext():
         task = progress.add_task("Generating captions", total=len(media_to_process))
 
         for media_file in media_to_process:
@@ -179,6 +216,11 @@ def caption_media(
                 # Store the caption with the relative path as key
                 captions[rel_path] = caption
 
+                if incremental_output is not None:
+                    _write_caption_record(incremental_output, rel_path, caption)
+                if stream is not None:
+                    _write_caption_record(stream, rel_path, caption)
+
             except Exception as e:
                 console.print(f"[bold red]Error captioning [bold blue]{media_file}[/]: {e}[/]")
 
@@ -196,6 +238,46 @@ def caption_media(
     )
 
 
+def _parse_shard(shard_str: str) -> tuple[int, int]:
+    """Parse a shard specification of the form "i/N" into an (index, count) tuple"""
+    try:
+        shard_index, num_shards = map(int, shard_str.split("/"))
+    except ValueError as e:
+        raise typer.BadParameter(f"Expected a shard in the format i/N, got {shard_str}", param_hint="shard") from e
+
+    if not 0 <= shard_index < num_shards:
+        raise typer.BadParameter(
+            f"Shard index must be between 0 and {num_shards - 1}, got {shard_index}",
+            param_hint="shard",
+        )
+
+    return shard_index, num_shards
+
+
+def _load_skip_list(skip_list_path: Path, base_dir: Path) -> set[Path]:
+    """Load a file with one media path per line. Relative paths are resolved against base_dir."""
+    with skip_list_path.open("r", encoding="utf-8") as f:
+        return {(base_dir / line.strip()).resolve() for line in f if line.strip()}
+
+
+def _open_jsonl_for_append(path: Path) -> TextIO:
+    """Open a JSON Lines file for appending, first dropping a truncated last line left by an interrupted run."""
+    if path.exists():
+        with path.open("rb+") as f:
+            content = f.read()
+            if content and not content.endswith(b"\n"):
+                f.truncate(content.rfind(b"\n") + 1)
+    else:
+        path.parent.mkdir(parents=True, exist_ok=True)
+    return path.open("a", encoding="utf-8")
+
+
+def _write_caption_record(stream: TextIO, media_path: str, caption: str) -> None:
+    """Write a single caption record to the stream (or file) as a JSON line and flush it immediately."""
+    stream.write(json.dumps({"caption": caption, "media_path": media_path}, ensure_ascii=False) + "\n")
+    stream.flush()
+
+
 def _get_media_files(
     input_path: Path,
     extensions: list[str] = MEDIA_EXTENSIONS,
@@ -211,7 +293,7 @@ def _get_media_files(
         if input_path.suffix.lstrip(".").lower() in extensions:
             return [input_path]
         else:
-            typer.echo(f"Warning: {input_path} is not a recognized media file. Skipping.")
+            typer.echo(f"Warning: {input_path} is not a recognized media file. Skipping.", err=True)
             return []
     elif input_path.is_dir():
         # If input is a directory, find all media files
@@ -226,7 +308,7 @@ def _get_media_files(
 
         return sorted(media_files)
     else:
-        typer.echo(f"Error: {input_path} does not exist.")
+        typer.echo(f"Error: {input_path} does not exist.", err=True)
         raise typer.Exit(code=1)
 
 
@@ -359,7 +441,11 @@ def _load_existing_captions(  # noqa: PLR0912
             case OutputFormat.JSONL:
                 with output_path.open("r", encoding="utf-8") as f:
                     for line in f:
-                        item = json.loads(line)
+                        try:
+                            item = json.loads(line)
+                        except json.JSONDecodeError:
+                            # An interrupted run can leave an empty or truncated last line
+                            continue
                         if "caption" in item and "media_path" in item:
                             existing_captions[item["media_path"]] = item["caption"]
 
@@ -369,7 +455,7 @@ def _load_existing_captions(  # noqa: PLR0912
         console.print(f"[bold green]✓[/] Loaded [bold]{len(existing_captions)}[/] existing captions")
         return existing_captions
 
-    except Exception as e:
+    except (OSError, ValueError, KeyError, TypeError, csv.Error) as e:
         console.print(f"[bold yellow]Warning: Could not load existing captions: {e}[/]")
         return {}
 
@@ -438,6 +524,24 @@ def main(  # noqa: PLR0913
         "--override",
         help="Whether to override existing captions for media",
     ),
+    stream: bool = typer.Option(
+        False,
+        "--stream",
+        help="Also write each caption record to stdout as a JSON line as soon as it is generated. "
+        "All other output is redirected to stderr.",
+    ),
+    shard: str | None = typer.Option(
+        None,
+        "--shard",
+        help="Only caption one of N disjoint slices of the media files, given as i/N (0-based index)",
+    ),
+    skip_list: Path | None = typer.Option(  # noqa: B008
+        None,
+        "--skip-list",
+        help="File with one media path per line (relative to the output file's directory) to leave out entirely",
+        exists=True,
+        dir_okay=False,
+    ),
 ) -> None:
     """Auto-caption videos and images using vision-language models.
 
@@ -445,6 +549,13 @@ def main(  # noqa: PLR0913
     captions using a vision-language model. The captions can be saved in various formats.
     """
 
+    parsed_shard = _parse_shard(shard) if shard else None
+
+    # When streaming, stdout is reserved for caption records and everything else goes to stderr
+    records_stream = sys.stdout if stream else None
+    if stream:
+        console.stderr = True
+
     # Determine device
     device = device or "cuda" if torch.cuda.is_available() else "cpu"
 
@@ -468,28 +579,32 @@ def main(  # noqa: PLR0913
     output = Path(output).resolve()
     console.print(f"Output will be saved to [bold blue]{output}[/]")
 
-    # Initialize captioning model
-    with console.status("Loading captioning model...", spinner="dots"):
-        captioner = create_captioner(
-            captioner_type=captioner_type,
-            device=device,
-            use_8bit=use_8bit,
-            vlm_instruction=instruction,
+    with redirect_stdout(sys.stderr) if stream else nullcontext():
+        # Initialize captioning model
+        with console.status("Loading captioning model...", spinner="dots"):
+            captioner = create_captioner(
+                captioner_type=captioner_type,
+                device=device,
+                use_8bit=use_8bit,
+                vlm_instruction=instruction,
+            )
+            console.print("[bold green]✓[/] Captioning model loaded successfully")
+
+        # Caption media files
+        caption_media(
+            input_path=input_path,
+            output_path=output,
+            captioner=captioner,
+            extensions=ext_list,
+            recursive=recursive,
+            frames_sampling_factor=frames_sampling_factor,
+            clean_caption=clean_caption,
+            output_format=output_format,
+            override=override,
+            stream=records_stream,
+            shard=parsed_shard,
+            skip=_load_skip_list(skip_list, output.parent) if skip_list else None,
         )
-        console.print("[bold green]✓[/] Captioning model loaded successfully")
-
-    # Caption media files
-    caption_media(
-        input_path=input_path,
-        output_path=output,
-        captioner=captioner,
-        extensions=ext_list,
-        recursive=recursive,
-        frames_sampling_factor=frames_sampling_factor,
-        clean_caption=clean_caption,
-        output_format=output_format,
-        override=override,
-    )
 
 
 if __name__ == "__main__":
@@ -13,8 +13,17 @@ Basic usage:
 The dataset can be either:
 1. A directory containing text files with captions and video paths
 2. A CSV, JSON, or JSONL file with columns for captions and video paths
+
+Records can also be streamed as JSON Lines on stdin, e.g. from caption_videos.py --stream.
+In that case the models are loaded while the records are still being produced:
+    caption_videos.py /path/to/dataset --output /path/to/dataset/captions.json --stream | \
+        preprocess_dataset.py /path/to/dataset --resolution-buckets 768x768x49 --stream
 """
 
+import json
+import signal
+import sys
+import tempfile
 from pathlib import Path
 from typing import Any
 
@@ -32,7 +41,7 @@ from rich.progress import (
     TimeElapsedColumn,
     TimeRemainingColumn,
 )
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Dataset, Subset
 from transformers.utils.logging import disable_progress_bar
 
 from ltxv_trainer.datasets import (
@@ -54,6 +63,9 @@ app = typer.Typer(
 VAE_SPATIAL_FACTOR = 32
 VAE_TEMPORAL_FACTOR = 8
 
+# Records which dataset item each precomputed file was computed from, so that unchanged items can be skipped
+PREPROCESSING_MANIFEST_FILE_NAME = ".manifest.jsonl"
+
 
 class PreprocessingArgs(BaseModel):
     """Arguments for dataset preprocessing"""
@@ -143,15 +155,48 @@ class DatasetPreprocessor:
             )
 
         # Set up data loading
-        dataloader = self._create_dataloader(
+        dataset = self._create_dataset(
             data_root=data_root,
             dataset_file=dataset_file,
             caption_column=args.caption_column,
             video_column=args.video_column,
             resolution_buckets=args.resolution_buckets,
+            id_token=args.id_token,
+        )
+
+        # Skip items whose outputs were already computed from the same media file, caption and resolution.
+        # Output files are matched to items by media path, so the order of the dataset does not matter.
+        manifest_path = output_base / PREPROCESSING_MANIFEST_FILE_NAME
+        manifest = self._load_manifest(manifest_path)
+        cache_keys = [self._get_cache_key(dataset, idx) for idx in range(len(dataset))]
+        file_indices = self._assign_file_indices(manifest, cache_keys)
+        pending_indices = [
+            idx
+            for idx, (file_idx, cache_key) in enumerate(zip(file_indices, cache_keys, strict=True))
+            if manifest.get(file_idx) != cache_key
+            or not (latents_dir / f"latent_{file_idx:08d}.pt").exists()
+            or not (conditions_dir / f"condition_{file_idx:08d}.pt").exists()
+        ]
+
+        # Remove the outputs of items that are no longer in the dataset, so they are not trained on
+        stale_file_indices = set(manifest) - set(file_indices)
+        for file_idx in stale_file_indices:
+            (latents_dir / f"latent_{file_idx:08d}.pt").unlink(missing_ok=True)
+            (conditions_dir / f"condition_{file_idx:08d}.pt").unlink(missing_ok=True)
+        if stale_file_indices:
+            self._update_manifest(manifest_path, dict.fromkeys(stale_file_indices))
+
+        if len(pending_indices) < len(dataset):
+            console.print(
+                f"[bold yellow]Skipping [bold]{len(dataset) - len(pending_indices)}[/] items "
+                f"that were already preprocessed.[/]",
+            )
+
+        dataloader = self._create_dataloader(
+            dataset=dataset,
+            indices=pending_indices,
             batch_size=args.batch_size,
             num_workers=args.num_workers,
-            id_token=args.id_token,
         )
 
         # Enable/disable VAE tiling
@@ -183,15 +228,20 @@ class DatasetPreprocessor:
             )
 
             for batch_idx, batch in enumerate(dataloader):
+                # The dataloader does not shuffle, so batches follow the order of the pending indices
+                batch_start = batch_idx * args.batch_size
+                batch_indices = pending_indices[batch_start : batch_start + len(batch["prompt"])]
+                batch_file_indices = [file_indices[idx] for idx in batch_indices]
+
                 self._process_batch(
                     batch=batch,
-                    batch_idx=batch_idx,
-                    batch_size=args.batch_size,
+                    file_indices=batch_file_indices,
                     latents_dir=latents_dir,
                     conditions_dir=conditions_dir,
                     output_base=output_base,
                     decode_videos=args.decode_videos,
                 )
+                self._update_manifest(manifest_path, {file_indices[idx]: cache_keys[idx] for idx in batch_indices})
                 progress.advance(task)
 
         # Print summary
@@ -222,17 +272,15 @@ class DatasetPreprocessor:
         return latents_dir, conditions_dir
 
     @staticmethod
-    def _create_dataloader(
+    def _create_dataset(
         data_root: str,
         dataset_file: str | None,
         caption_column: str,
         video_column: str,
         resolution_buckets: list[tuple[int, int, int]],
-        batch_size: int,
-        num_workers: int,
         id_token: str | None,
-    ) -> DataLoader:
-        """Initialize dataset and create dataloader"""
+    ) -> ImageOrVideoDatasetWithResizeAndRectangleCrop:
+        """Initialize the dataset"""
         with console.status("[bold]Loading dataset...", spinner="dots"):
             dataset = ImageOrVideoDatasetWithResizeAndRectangleCrop(
                 data_root=data_root,
@@ -244,19 +292,95 @@ class DatasetPreprocessor:
             )
 
         console.print(f"[bold green]✓[/] Dataset loaded with [bold]{len(dataset)}[/] items")
+        return dataset
 
+    @staticmethod
+    def _create_dataloader(
+        dataset: Dataset,
+        indices: list[int],
+        batch_size: int,
+        num_workers: int,
+    ) -> DataLoader:
+        """Create a dataloader over the given subset of dataset items"""
         return DataLoader(
-            dataset,
+            Subset(dataset, indices),
             batch_size=batch_size,
             num_workers=num_workers,
             shuffle=False,
         )
 
+    @staticmethod
+    def _get_cache_key(dataset: ImageOrVideoDatasetWithResizeAndRectangleCrop, idx: int) -> list:
+        """Return the inputs that the precomputed outputs of a dataset item depend on"""
+        video_path = dataset.video_paths[idx]
+        return [
+            str(video_path.resolve()),
+            video_path.stat().st_mtime_ns,
+            dataset.id_token + dataset.prompts[idx],
+            [list(bucket) for bucket in dataset.resolution_buckets],
+        ]
+
+    @staticmethod
+    def _load_manifest(manifest_path: Path) -> dict[int, list]:
+        """Load the cache keys of previously precomputed items, indexed by their output file index"""
+        if not manifest_path.exists():
+            return {}
+
+        # A run that was killed mid-write can leave a truncated last line. Drop it, so that entries appended
+        # later do not run into it.
+        with manifest_path.open("rb+") as f:
+            content = f.read()
+            if content and not content.endswith(b"\n"):
+                content = content[: content.rfind(b"\n") + 1]
+                f.truncate(len(content))
+
+        manifest = {}
+        for line in content.decode("utf-8", errors="replace").splitlines():
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            # Later entries override earlier ones for the same index, and a null key removes the index
+            if entry["key"] is None:
+                manifest.pop(entry["index"], None)
+            else:
+                manifest[entry["index"]] = entry["key"]
+        return manifest
+
+    @staticmethod
+    def _assign_file_indices(manifest: dict[int, list], cache_keys: list[list]) -> list[int]:
+        """Return the output file index of each dataset item.
+
+        Items keep the index their media file was precomputed under before; new media get unused indices.
+        """
+        # The same media file may appear more than once in a dataset, e.g. with different captions, so each path
+        # maps to all of its previous indices, which are handed out to its items in order
+        file_indices_by_path = {}
+        for file_idx, cache_key in sorted(manifest.items()):
+            file_indices_by_path.setdefault(cache_key[0], []).append(file_idx)
+        next_file_idx = max(manifest, default=-1) + 1
+        file_indices = []
+        for cache_key in cache_keys:
+            previous_file_indices = file_indices_by_path.get(cache_key[0])
+            if previous_file_indices:
+                file_idx = previous_file_indices.pop(0)
+            else:
+                file_idx = next_file_idx
+                next_file_idx += 1
+            file_indices.append(file_idx)
+        return file_indices
+
+    @staticmethod
+    def _update_manifest(manifest_path: Path, cache_keys: dict[int, list | None]) -> None:
+        """Append the cache keys of newly precomputed (or, for None, removed) items to the manifest"""
+        with manifest_path.open("a", encoding="utf-8") as f:
+            for idx, cache_key in cache_keys.items():
+                f.write(json.dumps({"index": idx, "key": cache_key}, ensure_ascii=False) + "\n")
+
     def _process_batch(
         self,
         batch: dict[str, Any],
-        batch_idx: int,
-        batch_size: int,
+        file_indices: list[int],
         latents_dir: Path,
         conditions_dir: Path,
         output_base: Path,
@@ -279,8 +403,7 @@ class DatasetPreprocessor:
         )
 
         # Save each item in the batch
-        for i in range(len(batch["prompt"])):
-            file_idx = batch_idx * batch_size + i
+        for i, file_idx in enumerate(file_indices):
             latent_path = latents_dir / f"latent_{file_idx:08d}.pt"
             condition_path = conditions_dir / f"condition_{file_idx:08d}.pt"
 
@@ -335,6 +458,39 @@ class DatasetPreprocessor:
                     )
 
 
+def _spool_stdin_records(data_root: Path) -> Path:
+    """Copy JSON Lines records from stdin to a temporary JSONL file in the data root.
+
+    The file is created inside data_root so that relative media paths in the records keep resolving.
+    """
+    with tempfile.NamedTemporaryFile(
+        "w",
+        encoding="utf-8",
+        dir=data_root,
+        prefix=".stream-",
+        suffix=".jsonl",
+        delete=False,
+    ) as f:
+        num_records = 0
+        try:
+            for line in sys.stdin:
+                if line.strip():
+                    f.write(line)
+                    num_records += 1
+        except BaseException:
+            f.close()
+            Path(f.name).unlink(missing_ok=True)
+            raise
+
+    console.print(f"[bold green]✓[/] Received [bold]{num_records}[/] records from stdin")
+    return Path(f.name)
+
+
+def _exit_on_sigterm(signum: int, frame: object) -> None:
+    """Turn SIGTERM into a SystemExit, so that cleanup in finally blocks still runs."""
+    raise SystemExit(128 + signum)
+
+
 def _parse_resolution_buckets(resolution_buckets_str: str) -> list[tuple[int, int, int]]:
     """Parse resolution buckets from string format to list of tuples"""
     resolution_buckets = []
@@ -415,13 +571,25 @@ def main(  # noqa: PLR0913
         default=False,
         help="Decode and save videos after encoding (for verification purposes)",
     ),
+    stream: bool = typer.Option(
+        default=False,
+        help="Read JSON Lines records from stdin instead of a metadata file. "
+        "dataset_path must then be the directory that media paths in the records are relative to.",
+    ),
 ) -> None:
     """Preprocess a video dataset by computing and saving latents and text embeddings.
 
-    The dataset can be specified in two ways:
+    The dataset can be specified in three ways:
     1. A directory containing text files with captions and video paths
     2. A CSV, JSON, or JSONL file with columns for captions and video paths
+    3. A directory combined with --stream, in which case JSON Lines records are read from stdin
     """
+    if stream and not Path(dataset_path).is_dir():
+        raise typer.BadParameter(
+            "When streaming records from stdin, dataset_path must be a directory.",
+            param_hint="dataset-path",
+        )
+
     parsed_resolution_buckets = _parse_resolution_buckets(resolution_buckets)
 
     if len(parsed_resolution_buckets) > 1:
@@ -430,25 +598,36 @@ def main(  # noqa: PLR0913
             param_hint="resolution-buckets",
         )
 
-    args = PreprocessingArgs(
-        dataset_path=dataset_path,
-        caption_column=caption_column,
-        video_column=video_column,
-        resolution_buckets=parsed_resolution_buckets,
-        batch_size=batch_size,
-        num_workers=num_workers,
-        output_dir=output_dir,
-        id_token=id_token,
-        vae_tiling=vae_tiling,
-        decode_videos=decode_videos,
-    )
+    if stream:
+        # The producer of the streamed records may stop this process with SIGTERM, which must still remove the spool
+        signal.signal(signal.SIGTERM, _exit_on_sigterm)
 
+    # Load the models first, so that this overlaps with whatever is producing the streamed records
     preprocessor = DatasetPreprocessor(
         model_source=model_source,
         device=device,
         load_text_encoder_in_8bit=load_text_encoder_in_8bit,
     )
-    preprocessor.preprocess(args)
+
+    spooled_path = _spool_stdin_records(Path(dataset_path)) if stream else None
+
+    try:
+        args = PreprocessingArgs(
+            dataset_path=str(spooled_path) if spooled_path else dataset_path,
+            caption_column=caption_column,
+            video_column=video_column,
+            resolution_buckets=parsed_resolution_buckets,
+            batch_size=batch_size,
+            num_workers=num_workers,
+            output_dir=output_dir,
+            id_token=id_token,
+            vae_tiling=vae_tiling,
+            decode_videos=decode_videos,
+        )
+        preprocessor.preprocess(args)
+    finally:
+        if spooled_path is not None:
+            spooled_path.unlink(missing_ok=True)
 
 
 if __name__ == "__main__":
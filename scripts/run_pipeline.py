@@ -3,49 +3,334 @@
 End-to-End Video Training Pipeline
 
 This script:
-  1. Captions videos using caption_videos.py.
-  2. Preprocesses the dataset using preprocess_dataset.py.
+  1. Captions videos using caption_videos.py, running one captioner per GPU on disjoint shards
+     of the dataset and merging the shard captions afterwards.
+  2. Preprocesses the dataset using preprocess_dataset.py. Captions are streamed from the
+     captioner into preprocessing as they are produced, so the two steps overlap.
   3. Loads an existing YAML training configuration, updates key parameters 
      (such as file paths, output directory, resolution buckets, training token, 
      and video dimensions), and writes the updated config to a timestamped folder.
   4. Runs training using train.py with the updated configuration.
 
+Captioning and preprocessing are driven with asyncio subprocesses, so that independent work (preprocessing
+model loading, updating the config) overlaps with captioning instead of waiting for it. Training runs
+in-process, as the last stage.
+
 If no caption output file is specified, it will be automatically saved as 
-"captions.json" in the dataset folder and then used for preprocessing.
+"captions.jsonl" (JSON Lines) in the dataset folder and then used for preprocessing.
 """
 
 import argparse
+import asyncio
+import glob
+import json
+import re
 import subprocess
 import os
 import sys
 import datetime
 import yaml
 
-def run_captioning(args, captions_output):
-    """Run the captioning step."""
-    caption_cmd = [
-        sys.executable, os.path.join("scripts", "caption_videos.py"),
-        args.dataset_dir,
-        "--output", captions_output,
-        "--captioner-type", args.captioner_type
-    ]
-    print("Running captioning:")
-    print(" ".join(caption_cmd))
-    subprocess.run(caption_cmd, check=True)
+# Prefer the libyaml-backed loader/dumper; fall back to the pure-Python ones if PyYAML was built without libyaml.
+try:
+    from yaml import CSafeDumper as SafeDumper
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeDumper, SafeLoader
+
+# Video dimensions / resolution bucket in WxHxF format, e.g. 768x768x89
+_DIMS_RE = re.compile(r'^(\d+)x(\d+)x(\d+)$')
+
+# Maximum number of caption records buffered between the captioners and the preprocessor
+MAX_RECORDS_IN_FLIGHT = 32
+
+def parse_dims(value):
+    """Parse a WxHxF string (e.g. 768x768x89) into a [width, height, frames] list, for use as an argparse type."""
+    m = _DIMS_RE.match(value)
+    if m is None:
+        raise argparse.ArgumentTypeError(f"expected WxHxF format (e.g. 768x768x89), got {value!r}")
+    return [int(x) for x in m.groups()]
+
+def format_dims(dims):
+    """Format a [width, height, frames] list back into its WxHxF string form."""
+    return "x".join(str(x) for x in dims)
+
+def get_visible_gpus():
+    """Return the ids of the GPUs visible to this process (an empty list on CPU-only hosts)."""
+    import torch
+
+    num_gpus = torch.cuda.device_count()
+    visible = os.environ.get("CUDA_VISIBLE_DEVICES")
+    if visible:
+        return [gpu.strip() for gpu in visible.split(",") if gpu.strip()][:num_gpus]
+    return [str(i) for i in range(num_gpus)]
+
+def get_shard_output(captions_output, shard_index):
+    """Return the captions file for a single shard, e.g. captions.shard0.jsonl for captions.jsonl."""
+    root, ext = os.path.splitext(captions_output)
+    return f"{root}.shard{shard_index}{ext}"
+
+def remove_shard_outputs(captions_output):
+    """Remove the per-shard caption files written for captions_output by earlier runs."""
+    root, ext = os.path.splitext(captions_output)
+    for shard_output in glob.glob(f"{glob.escape(root)}.shard*{glob.escape(ext)}"):
+        os.remove(shard_output)
+
+def get_media_mtime(captions_output, media_path):
+    """Return the mtime of a media file given by its path relative to the captions file, or None if it is gone."""
+    try:
+        return os.stat(os.path.join(os.path.dirname(os.path.abspath(captions_output)), media_path)).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+def load_completed_captions(captions_output):
+    """
+    Load the caption records completed by previous runs from the captions_output + ".done" sidecar.
+
+    Records whose media file was modified (or removed) since it was captioned are dropped, and the
+    sidecar is rewritten with the remaining ones.
+    """
+    done_path = captions_output + ".done"
+    if not os.path.exists(done_path):
+        return {}
+
+    completed = {}
+    with open(done_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # A run that was killed mid-write can leave a truncated last line
+                continue
+            if get_media_mtime(captions_output, record['media_path']) == record['mtime_ns']:
+                completed[record['media_path']] = record
+
+    with open(done_path, 'w', encoding='utf-8') as f:
+        f.writelines(json.dumps(record, ensure_ascii=False) + "\n" for record in completed.values())
+    return completed
+
+async def wait_for_stage(cmd, process):
+    """Wait for a stage's process to exit, raising if it failed."""
+    if await process.wait() != 0:
+        raise subprocess.CalledProcessError(process.returncode, cmd)
 
-def run_preprocessing(args, captions_output):
-    """Run the preprocessing step."""
+async def run_captioning(args, captions_output, num_shards, gpus, skip_list):
+    """
+    Start the captioning step as one captioner process per shard of the dataset.
+
+    Each captioner streams a JSON line per captioned video to its stdout, which is returned as a pipe
+    so that preprocessing can consume the records while later videos are still being captioned.
+    Shard i writes its captions to its own file and, if GPUs are available, runs on GPU i.
+    """
+    captioners = []
+    for shard_index in range(num_shards):
+        caption_cmd = [
+            sys.executable, os.path.join("scripts", "caption_videos.py"),
+            args.dataset_dir,
+            "--output", get_shard_output(captions_output, shard_index),
+            "--captioner-type", args.captioner_type,
+            "--shard", f"{shard_index}/{num_shards}",
+            "--skip-list", skip_list,
+            "--stream"
+        ]
+        env = os.environ.copy()
+        if gpus:
+            env["CUDA_VISIBLE_DEVICES"] = gpus[shard_index % len(gpus)]
+        print(f"Running captioning (shard {shard_index}/{num_shards}):")
+        print(" ".join(caption_cmd))
+        captioner = await asyncio.create_subprocess_exec(*caption_cmd, stdout=asyncio.subprocess.PIPE, env=env)
+        captioners.append((caption_cmd, captioner))
+    return captioners
+
+async def run_preprocessing(args, captions_output):
+    """Start the preprocessing step, reading caption records from its stdin pipe."""
     preprocess_cmd = [
         sys.executable, os.path.join("scripts", "preprocess_dataset.py"),
-        captions_output,
+        os.path.dirname(os.path.abspath(captions_output)),
         "--caption-column", args.caption_column,
         "--video-column", args.video_column,
         "--id-token", args.id_token,
-        "--resolution-buckets", args.resolution_buckets
+        "--resolution-buckets", format_dims(args.resolution_buckets),
+        "--stream"
     ]
     print("Running preprocessing:")
     print(" ".join(preprocess_cmd))
-    subprocess.run(preprocess_cmd, check=True)
+    return preprocess_cmd, await asyncio.create_subprocess_exec(*preprocess_cmd, stdin=asyncio.subprocess.PIPE)
+
+async def read_records(src, queue, done, captions_output):
+    """
+    Read JSON lines from a captioner's stdout into the queue of records bound for the preprocessor.
+
+    Every record is also appended to the done sidecar along with the mtime of its media file,
+    so that it does not need to be captioned again if a later stage fails.
+    """
+    async for line in src:
+        record = json.loads(line)
+        record['mtime_ns'] = get_media_mtime(captions_output, record['media_path'])
+        done.write(json.dumps(record, ensure_ascii=False) + "\n")
+        done.flush()
+        # Blocks while the queue is full, which in turn makes the captioner block on its stdout pipe
+        await queue.put(line)
+
+async def queue_completed_records(queue, completed):
+    """Queue the caption records reused from previous runs for the preprocessor."""
+    for record in completed.values():
+        line = json.dumps({"caption": record['caption'], "media_path": record['media_path']}, ensure_ascii=False)
+        await queue.put((line + "\n").encode("utf-8"))
+
+async def write_records(queue, dst):
+    """Write the queued records to the preprocessor's stdin, one whole line at a time, until None is queued."""
+    while (line := await queue.get()) is not None:
+        try:
+            dst.write(line)
+            await dst.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            # The preprocessor exited; keep consuming so the captioners do not block on a full queue
+            pass
+
+def read_caption_records(captions_file):
+    """Yield the caption records of a JSON Lines (or, for older runs, JSON) captions file."""
+    with open(captions_file, 'r', encoding='utf-8') as f:
+        if not captions_file.endswith('.jsonl'):
+            yield from json.load(f)
+            return
+        for line in f:
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                # An interrupted captioner can leave an empty or truncated last line
+                continue
+
+def merge_caption_shards(shard_outputs, captions_output, completed):
+    """Merge the per-shard caption files and the previously completed captions into a single captions file."""
+    captions = {media_path: record['caption'] for media_path, record in completed.items()}
+    for shard_output in shard_outputs:
+        if os.path.exists(shard_output):
+            captions.update({item['media_path']: item['caption'] for item in read_caption_records(shard_output)})
+
+    records = [{"caption": caption, "media_path": media_path} for media_path, caption in sorted(captions.items())]
+    with open(captions_output, 'w', encoding='utf-8') as f:
+        if captions_output.endswith('.jsonl'):
+            f.writelines(json.dumps(record, ensure_ascii=False) + "\n" for record in records)
+        else:
+            json.dump(records, f, indent=2, ensure_ascii=False)
+    print(f"Merged {len(captions)} captions into: {captions_output}")
+
+async def run_captioning_and_preprocessing(args, captions_output):
+    """Run sharded captioning and preprocessing as a pipeline, so the two stages overlap."""
+    # Media captioned by earlier (possibly failed) runs are not captioned again. The done sidecar is the only
+    # record of that: the captioners would otherwise also resume from their shard files, and re-stream the old
+    # captions of media modified since, so the shard files of earlier runs are removed.
+    completed = load_completed_captions(captions_output)
+    remove_shard_outputs(captions_output)
+    skip_list = captions_output + ".skip"
+    with open(skip_list, 'w', encoding='utf-8') as f:
+        f.writelines(media_path + "\n" for media_path in completed)
+    if completed:
+        print(f"Reusing {len(completed)} captions from previous runs.")
+
+    # Start preprocessing first, so that its model loading overlaps with probing the GPUs and starting the captioners
+    preprocess_cmd, preprocessor = await run_preprocessing(args, captions_output)
+
+    gpus = await asyncio.to_thread(get_visible_gpus)
+    num_shards = args.num_shards or max(len(gpus), 1)
+    captioners = await run_captioning(args, captions_output, num_shards, gpus, skip_list)
+
+    with open(captions_output + ".done", 'a', encoding='utf-8') as done:
+        # The captioners feed a bounded queue drained by a single writer, which caps the number of
+        # records in flight and applies back-pressure to the captioners if preprocessing falls behind
+        queue = asyncio.Queue(maxsize=MAX_RECORDS_IN_FLIGHT)
+        writer = asyncio.create_task(write_records(queue, preprocessor.stdin))
+        # The preprocessor only reads stdin once its models are loaded, so the reused records go through the
+        # queue as well rather than being written up front, which could block before the captioners start
+        readers = [asyncio.create_task(queue_completed_records(queue, completed))] + [
+            asyncio.create_task(read_records(captioner.stdout, queue, done, captions_output))
+            for _, captioner in captioners
+        ]
+        waiters = [asyncio.create_task(wait_for_stage(cmd, captioner)) for cmd, captioner in captioners]
+        finished, pending = await asyncio.wait([*waiters, *readers], return_when=asyncio.FIRST_EXCEPTION)
+
+        # A failed captioner would hand preprocessing an incomplete dataset, so stop it early. The same goes
+        # for a failed reader (e.g. a captioner printing something other than a record), whose captioner
+        # would otherwise block forever on its unread stdout pipe.
+        # Captions that were already read are kept in the done sidecar for the next run. The remaining records are
+        # dropped rather than forwarded, as the preprocessor may still be loading its models and is stopped anyway.
+        failed = [task for task in finished if task.exception() is not None]
+        if failed:
+            for task in [*pending, writer]:
+                task.cancel()
+            for _, captioner in captioners:
+                if captioner.returncode is None:
+                    captioner.terminate()
+            preprocessor.terminate()
+            await asyncio.gather(*pending, writer, return_exceptions=True)
+            await asyncio.gather(*(captioner.wait() for _, captioner in captioners), preprocessor.wait())
+            raise failed[0].exception()
+
+        await queue.put(None)
+        await writer
+
+    # Closing stdin signals EOF to the preprocessor once all records have been forwarded
+    preprocessor.stdin.close()
+    try:
+        await preprocessor.stdin.wait_closed()
+    except (BrokenPipeError, ConnectionResetError):
+        pass
+
+    shard_outputs = [get_shard_output(captions_output, i) for i in range(num_shards)]
+    merge_caption_shards(shard_outputs, captions_output, completed)
+    # The merged captions file and the done sidecar now hold everything the shard files and the skip list did
+    remove_shard_outputs(captions_output)
+    os.remove(skip_list)
+
+    await wait_for_stage(preprocess_cmd, preprocessor)
+
+def patch_yaml_value(text, section, key, value):
+    """
+    Set section.key (or the top-level key if section is None) to value in the YAML text, keeping comments and order.
+
+    Only simple block-style mappings with single-line scalar or flow values are handled. Returns None if the
+    structure is not recognized, in which case the caller should fall back to a full parse and dump.
+    """
+    # JSON scalars and lists are valid YAML flow values
+    value_str = json.dumps(value, ensure_ascii=False)
+
+    if section is None:
+        start, end, indent = 0, len(text), ''
+    else:
+        header = re.search(rf'^{re.escape(section)}:[ \t]*(?:#.*)?$', text, re.M)
+        if header is None:
+            return None
+        start = header.end()
+        # The section ends at the next line that starts with something other than whitespace or a comment
+        section_end = re.compile(r'^(?=[^\s#])', re.M).search(text, start + 1)
+        end = section_end.start() if section_end else len(text)
+        first_child = re.compile(r'^([ \t]+)[^\s#]', re.M).search(text, start, end)
+        indent = first_child.group(1) if first_child else '  '
+
+    line = re.compile(rf'^{indent}{re.escape(key)}:(.*)$', re.M).search(text, start, end)
+    if line is None:
+        # Key is absent: add it as the first entry of its section (or at the end of the document)
+        if section is None:
+            return text.rstrip('\n') + f"\n{key}: {value_str}\n"
+        return text[:start] + f"\n{indent}{key}: {value_str}" + text[start:]
+
+    old_value = line.group(1)
+    comment = ''
+    if '#' in old_value:
+        if '"' in old_value or "'" in old_value:
+            return None  # The '#' may be inside a quoted string
+        old_value, _, comment = old_value.partition('#')
+        comment = ' #' + comment
+    if not old_value.strip():
+        return None  # Block value spanning the following lines
+    if old_value.count('[') != old_value.count(']') or old_value.count('{') != old_value.count('}'):
+        return None  # Flow value continuing on the following lines
+    next_line = re.compile(r'^([ \t]*)[^\s#]', re.M).search(text, line.end() + 1)
+    if next_line is not None and len(next_line.group(1)) > len(indent):
+        return None  # Value continuing on a more indented line
+
+    return text[:line.start(1)] + f" {value_str}{comment}" + text[line.end(1):]
 
 def update_yaml_config(args, training_output_dir):
     """
@@ -56,58 +341,81 @@ def update_yaml_config(args, training_output_dir):
       - validation.video_dims (from --video_dims or derived from resolution_buckets)
       - data.training_token (set to id_token)
       - output_dir (set to a unique timestamped folder)
+
+    The updated values are patched into the YAML text, which keeps the template's comments and key order.
+    If the template's structure is not recognized, it is fully parsed, updated and dumped instead.
     """
-    with open(args.config_path, 'r') as f:
-        config = yaml.safe_load(f)
+    updates = []
 
     # Set preprocessed data root (override or default to dataset_dir/.precomputed)
     if args.preprocessed_data_root:
-        config['data']['preprocessed_data_root'] = args.preprocessed_data_root
+        updates.append(('data', 'preprocessed_data_root', args.preprocessed_data_root))
     else:
-        config['data']['preprocessed_data_root'] = os.path.join(args.dataset_dir, ".precomputed")
+        updates.append(('data', 'preprocessed_data_root', os.path.join(args.dataset_dir, ".precomputed")))
 
     # Set a unique output directory for training
-    config['output_dir'] = training_output_dir
+    updates.append((None, 'output_dir', training_output_dir))
 
-    # Update video dimensions if provided, or derive from resolution_buckets if possible
-    if args.video_dims:
-        try:
-            dims = [int(x) for x in args.video_dims.split('x')]
-            if len(dims) != 3:
-                raise ValueError("video_dims must be in WxHxF format.")
-            config['validation']['video_dims'] = dims
-        except Exception as e:
-            print("Error parsing --video_dims:", e)
-    else:
-        # Fallback to using resolution_buckets (if in WxHxF format)
-        try:
-            dims = [int(x) for x in args.resolution_buckets.split('x')]
-            if len(dims) == 3:
-                config['validation']['video_dims'] = dims
-        except Exception as e:
-            print("Error parsing resolution_buckets for video_dims:", e)
+    # Update video dimensions if provided, or derive them from resolution_buckets (both are validated by argparse)
+    updates.append(('validation', 'video_dims', args.video_dims or args.resolution_buckets))
 
     # Update training token in data section
-    config['data']['training_token'] = args.id_token
+    updates.append(('data', 'training_token', args.id_token))
+
+    with open(args.config_path, 'r') as f:
+        text = f.read()
+    for section, key, value in updates:
+        text = patch_yaml_value(text, section, key, value)
+        if text is None:
+            break
+
+    # Make sure the patched text parses and carries the updated values before using it
+    if text is not None:
+        try:
+            patched = yaml.load(text, Loader=SafeLoader)
+            if any((patched[section] if section else patched)[key] != value for section, key, value in updates):
+                text = None
+        except (yaml.YAMLError, KeyError, TypeError):
+            text = None
 
     # Save the updated configuration to a new YAML file in the training output folder.
     updated_config_filename = os.path.basename(args.config_path).replace('.yaml', '_updated.yaml')
     updated_config_path = os.path.join(training_output_dir, updated_config_filename)
     with open(updated_config_path, 'w') as f:
-        yaml.dump(config, f)
+        if text is not None:
+            f.write(text)
+        else:
+            with open(args.config_path, 'r') as template:
+                config = yaml.load(template, Loader=SafeLoader)
+            for section, key, value in updates:
+                (config[section] if section else config)[key] = value
+            yaml.dump(config, f, Dumper=SafeDumper)
 
     print(f"Updated YAML config saved to: {updated_config_path}")
     return updated_config_path
 
 def run_training(updated_config_path):
-    """Run the training step using the updated YAML configuration."""
-    train_cmd = [
-        sys.executable, os.path.join("scripts", "train.py"),
-        updated_config_path
-    ]
-    print("Running training:")
-    print(" ".join(train_cmd))
-    subprocess.run(train_cmd, check=True)
+    """
+    Run the training step using the updated YAML configuration.
+
+    Training is the last stage and nothing else holds GPU memory by then, so it runs in this process
+    instead of paying for another interpreter start and torch import. train.py is imported lazily
+    to keep that cost out of the earlier, subprocess-based stages.
+    """
+    import train
+
+    print(f"Running training with config: {updated_config_path}")
+    train.main(updated_config_path)
+
+async def run_stages(args, training_output_dir):
+    """Run captioning and preprocessing while updating the YAML config, returning the updated config path."""
+    # Step 3 does not depend on the earlier steps, so update the YAML config while they run.
+    update_config = asyncio.create_task(asyncio.to_thread(update_yaml_config, args, training_output_dir))
+
+    # Steps 1 & 2: Run captioning and preprocessing, streaming captions into preprocessing as they are produced.
+    await run_captioning_and_preprocessing(args, args.captions_output)
+
+    return await update_config
 
 def main():
     parser = argparse.ArgumentParser(
@@ -116,32 +424,36 @@ def main():
     # Required: dataset folder path
     parser.add_argument("dataset_dir", type=str, help="Path to the folder containing videos")
     
-    # Optional output file for captions (if not given, will use dataset_dir/captions.json)
+    # Optional output file for captions (if not given, will use dataset_dir/captions.jsonl)
     parser.add_argument("--captions_output", type=str, default=None,
-                        help="File path for saving captions JSON. Default: dataset_dir/captions.json")
+                        help="File path for saving captions as JSON Lines (.jsonl) or JSON (.json). "
+                             "Default: dataset_dir/captions.jsonl")
 
     # Optional base directory for training outputs
     parser.add_argument("--output_dir_base", type=str, default="outputs", help="Base directory for training outputs")
 
     # Captioning parameters
     parser.add_argument("--captioner_type", type=str, default="llava_next_7b", help="Type of captioner to use")
+    parser.add_argument("--num_shards", type=int, default=None,
+                        help="Number of parallel captioner processes. Default: one per visible GPU (1 on CPU-only hosts)")
 
     # Preprocessing parameters
     parser.add_argument("--caption_column", type=str, default="caption", help="Caption column name")
     parser.add_argument("--video_column", type=str, default="media_path", help="Video path column name")
     parser.add_argument("--id_token", type=str, default="T1m3l4ps3", help="Training token for preprocessing")
-    parser.add_argument("--resolution_buckets", type=str, default="768x768x25", help="Resolution buckets in WxHxF format")
+    parser.add_argument("--resolution_buckets", type=parse_dims, default="768x768x25",
+                        help="Resolution bucket in WxHxF format")
 
     # YAML config parameters
     parser.add_argument("--config_path", type=str, default="configs/ltxv_2b_lora.yaml", help="Path to the YAML training config")
     parser.add_argument("--preprocessed_data_root", type=str, default=None, help="Override for data.preprocessed_data_root in YAML")
-    parser.add_argument("--video_dims", type=str, default="768x768x89", help="Override for validation.video_dims in WxHxF format (e.g., 768x768x89)")
+    parser.add_argument("--video_dims", type=parse_dims, default="768x768x89", help="Override for validation.video_dims in WxHxF format (e.g., 768x768x89)")
 
     args = parser.parse_args()
 
-    # Set default captions_output if not provided: save in dataset folder as captions.json
+    # Set default captions_output if not provided: save in dataset folder as captions.jsonl
     if args.captions_output is None:
-        args.captions_output = os.path.join(args.dataset_dir, "captions.json")
+        args.captions_output = os.path.join(args.dataset_dir, "captions.jsonl")
 
     # Create a unique timestamped folder for training outputs.
     timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
@@ -149,14 +461,8 @@ def main():
     os.makedirs(training_output_dir, exist_ok=True)
     print(f"Training output directory: {training_output_dir}")
 
-    # Step 1: Run captioning.
-    run_captioning(args, args.captions_output)
-
-    # Step 2: Run preprocessing.
-    run_preprocessing(args, args.captions_output)
-
-    # Step 3: Update the YAML config.
-    updated_config_path = update_yaml_config(args, training_output_dir)
+    # Steps 1-3: Caption, preprocess and update the YAML config.
+    updated_config_path = asyncio.run(run_stages(args, training_output_dir))
 
     # Step 4: Run training.
     run_training(updated_config_path)
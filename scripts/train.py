@@ -15,6 +15,7 @@ from pathlib import Path
 
 import typer
 import yaml
+from pydantic import ValidationError
 from rich.console import Console
 
 from ltxv_trainer.config import LtxvTrainerConfig
@@ -42,7 +43,7 @@ def main(config_path: str = typer.Argument(..., help="Path to YAML configuration
     # Convert the loaded data to the LtxvTrainerConfig object
     try:
         trainer_config = LtxvTrainerConfig(**config_data)
-    except Exception as e:
+    except (ValidationError, TypeError) as e:
         typer.echo(f"Error: Invalid configuration data: {e}")
         raise typer.Exit(code=1) from e
 
@@ -300,11 +300,15 @@ class ImageOrVideoDataset(Dataset):
         return prompts, video_paths
 
     def _load_dataset_from_jsonl(self) -> tuple[list[str], list[Path]]:
+        # Read the file record by record, without holding all decoded entries in memory at once
+        prompts, video_paths = [], []
         with open(self.dataset_file, "r", encoding="utf-8") as file:
-            data = [json.loads(line) for line in file]
-
-        prompts = [entry[self.caption_column] for entry in data]
-        video_paths = [self.data_root.joinpath(entry[self.video_column].strip()) for entry in data]
+            for line in file:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                prompts.append(entry[self.caption_column])
+                video_paths.append(self.data_root.joinpath(entry[self.video_column].strip()))
 
         if any(not path.is_file() for path in video_paths):
             raise ValueError(